@@ -1,15 +1,14 @@
 """ Demo program showing how to process audio in real time using Python.
-Requires PortAudio and pyaudio.
+Requires Python 3, PortAudio, pyaudio, numpy and numba.
 """
 
 __author__ = 'Paolo Prandoni'
 
 import pyaudio
-import time
 import os
 import numpy as np
-if os.name == 'nt':
-    WINDOWS = True
+WINDOWS = os.name == 'nt'
+if WINDOWS:
     import msvcrt
 else:
     import select
@@ -21,6 +20,9 @@ import sys
 RATE = 16000
 CHANNELS = 1
 
+# number of frames processed per block (power of two)
+BLOCK_SIZE = 256
+
 # number of buffers in pipe. reduce for lower latency
 DELAY = 5
 
@@ -30,21 +32,36 @@ PROCESSING_MODULE = "guitar_effects"
 
 def poll_keyboard():
     # check for key presses in a platform-independent way
-    global WINDOWS
     if WINDOWS:
         key = ord(msvcrt.getch()) if msvcrt.kbhit() else 0
     else:
-        key, _, _ = select.select([sys.stdin], [], [], 0)
+        ready, _, _ = select.select([sys.stdin], [], [], 0)
+        # at end of input stdin stays readable but read() returns ''
+        ch = sys.stdin.read(1) if ready else ''
+        key = ord(ch) if ch else 0
     return key
 
 
 
 def print_choices(choices, key):
     # print available processing choices
-    print '\n\nnow using processor ', choices[key]
-    print "available choices:"
+    print('\n\nnow using processor ', choices[key])
+    print("available choices:")
+    for ix in choices:
+        print(ix, ') ', choices[ix])
+
+
+
+def warm_up(processing_module, choices):
+    # instantiate each processor once and run it on a block of silence so
+    # that no first-call initialization happens once the audio stream is
+    # running. The instances are returned and reused when switching, so
+    # each processor also keeps its filter history across switches
+    processors = {}
     for ix in choices:
-        print ix, ') ', choices[ix]
+        processors[ix] = getattr(processing_module, choices[ix])(RATE, CHANNELS)
+        processors[ix].process_block(np.zeros(BLOCK_SIZE * CHANNELS, dtype=np.int32))
+    return processors
 
 
 
@@ -59,16 +76,9 @@ def main():
     for ix, c in enumerate(p):
         choices[ix+1] = c[1]
 
-    # callback function for the audio pipe. Process data and return
-    # the proc variable is user-updated in the main loop
-    def callback(in_data, frame_count, time_info, status):
-        audio_data = np.fromstring(in_data, dtype=np.int32)
-        for n in range(0, len(audio_data)):
-            audio_data[n] = np.int32(processor.process(audio_data[n]))
-        return (audio_data, pyaudio.paContinue)
-
     # instantiate pyaudio
     pa = pyaudio.PyAudio()
+    processors = warm_up(processing_module, choices)
     # open a bidirectional stream; a "frame" is a set of concurrent
     # samples (2 for stereo, 1 for mono) so the frames_per_buffer param
     # gives the size of the input and output buffers
@@ -76,37 +86,42 @@ def main():
         format=pyaudio.paInt32,
         channels=CHANNELS,
         rate=RATE,
-            frames_per_buffer=1,
+        frames_per_buffer=BLOCK_SIZE,
         input=True,
-        output=True,
-        stream_callback=callback)
+        output=True)
 
-    print "\nstarting audio processing"
-    print "press Q at any time to quit\n"
+    print("\nstarting audio processing")
+    print("press Q at any time to quit\n")
 
     # default processing module is the "no processing"
     key = 0
-    processor = getattr(processing_module, choices[key])(RATE, CHANNELS)
+    processor = processors[key]
     print_choices(choices, key)
 
-    # start recording and playing
+    # start recording and playing. We use blocking I/O rather than a
+    # callback: read a block, process it and write it back; the keyboard
+    # is polled in between (a block lasts BLOCK_SIZE / RATE seconds)
     stream.start_stream()
-    while stream.is_active():
-        key = poll_keyboard()
-        if key == ord('q'):
-            break
-        else:
-            key = key - ord('0')
-            try:
-                processor = getattr(processing_module, choices[key])(RATE, CHANNELS)
-                print_choices(choices, key)
-            except KeyError:
-                pass
-        time.sleep(0.1)
-
-    stream.stop_stream()
-    stream.close()
-    pa.terminate()
+    try:
+        while True:
+            key = poll_keyboard()
+            if key == ord('q'):
+                break
+            else:
+                key = key - ord('0')
+                try:
+                    processor = processors[key]
+                    print_choices(choices, key)
+                except KeyError:
+                    pass
+            in_data = stream.read(BLOCK_SIZE, exception_on_overflow=False)
+            audio_data = np.frombuffer(in_data, dtype=np.int32)
+            stream.write(processor.process_block(audio_data).tobytes())
+    finally:
+        # always release the stream and PortAudio, even on errors or Ctrl-C
+        stream.stop_stream()
+        stream.close()
+        pa.terminate()
 
 
 
@@ -1,13 +1,69 @@
 """ Guitar effects for real-time audio processing
 
 The following classes derived from RTProcessor implement a variety of simple
-real-time guitar effects
+real-time guitar effects. The recursive filters are compiled with numba;
+the kernels have explicit signatures so they are compiled (or loaded from the
+on-disk cache) when the module is imported rather than on their first call
+from the audio thread.
 """
 
 __author__ = 'Paolo Prandoni'
 
 import numpy as np
-from rtprocessor import RTProcessor, Delta
+from numba import njit, float32, void
+from rtprocessor import RTProcessor, Delta, CircularBuffer
+
+
+@njit(void(float32[:, :], float32[:, :], float32[:, :], float32[:, :],
+           float32, float32, float32, float32, float32),
+      cache=True, fastmath=True, boundscheck=False)
+def biquad_block(x, y, x_state, y_state, b0, b1, b2, a1, a2):
+    # second-order recursion over a block of frames, written into y. The
+    # recursion runs over frames; within a frame all channels are updated
+    # together from length-channels state vectors, so the inner loop has
+    # no dependencies and can be vectorized across channels. The state
+    # rows are updated in place and carried over between blocks
+    xm1, xm2 = x_state[0], x_state[1]
+    ym1, ym2 = y_state[0], y_state[1]
+    for i in range(x.shape[0]):
+        for c in range(x.shape[1]):
+            yi = b0 * x[i, c] + b1 * xm1[c] + b2 * xm2[c] - a1 * ym1[c] - a2 * ym2[c]
+            xm2[c] = xm1[c]
+            xm1[c] = x[i, c]
+            ym2[c] = ym1[c]
+            ym1[c] = yi
+            y[i, c] = yi
+
+
+@njit(void(float32[:, :], float32[:, :], float32[:], float32[:],
+           float32, float32, float32, float32[:, :], float32[:, :]),
+      cache=True, fastmath=True, boundscheck=False)
+def wah_block(x, y, b1, a1, b0, b2, a2, x_state, y_state):
+    # same as biquad_block but with time-varying b1 and a1, one per frame
+    xm1, xm2 = x_state[0], x_state[1]
+    ym1, ym2 = y_state[0], y_state[1]
+    for i in range(x.shape[0]):
+        for c in range(x.shape[1]):
+            yi = b0 * x[i, c] + b1[i] * xm1[c] + b2 * xm2[c] - a1[i] * ym1[c] - a2 * ym2[c]
+            xm2[c] = xm1[c]
+            xm1[c] = x[i, c]
+            ym2[c] = ym1[c]
+            ym1[c] = yi
+            y[i, c] = yi
+
+
+@njit(void(float32[:, :], float32[:, :], float32[:], float32),
+      cache=True, fastmath=True, boundscheck=False)
+def leaky_block(v, y, y_prev, l):
+    # y[n] = v[n] + l y[n-1] over a block of frames, written into y,
+    # starting from the last output frame of the previous block; frames
+    # in the outer loop, channels in the inner one as in biquad_block.
+    # v and y may be the same array
+    for c in range(v.shape[1]):
+        y[0, c] = v[0, c] + l * y_prev[c]
+    for i in range(1, v.shape[0]):
+        for c in range(v.shape[1]):
+            y[i, c] = v[i, c] + l * y[i - 1, c]
 
 
 class Echo(RTProcessor):
@@ -15,21 +71,40 @@ class Echo(RTProcessor):
     """
     order = 10
     def __init__(self, rate, channels):
-        # we will need a second's worth of buffering
-        super(Echo, self).__init__(rate, channels, max_delay=rate)
-
-        self.a = 1
-        self.b = 0.7
-        self.c = 0.5
-        self.norm = 1.0 / (self.a + self.b + self.c)
+        # the delay line is kept in a circular buffer
+        super(Echo, self).__init__(rate, channels, max_delay=0)
+
+        a, b, c = 1, 0.7, 0.5
+        # fold the normalization into the tap gains
+        norm = 1.0 / (a + b + c)
+        self.a = np.float32(norm * a)
+        self.b = np.float32(norm * b)
+        self.c = np.float32(norm * c)
         self.N = int(0.3 * self.SF)
 
+        # tap gains and delays
+        self.taps = np.array([self.a, self.b, self.c], dtype=np.float32)
+        self.delays = (0, self.N, 2 * self.N)
+        # room for the taps plus a chunk of up to N samples
+        self.x = CircularBuffer(3 * self.N, channels)
+        # gather buffer for the delayed samples of a chunk, one column per tap
+        self.gather = np.empty((self.N, channels, len(self.taps)), dtype=np.float32)
+
 
-    def _process(self):
-         return self.norm * (
-             self.a * self.x.get(0) +
-             self.b * self.x.get(self.N) +
-             self.c * self.x.get(2 * self.N))
+    def _process_block(self, x, y):
+        # y[n] = ax[n] + bx[n-N] + cx[n-2N]
+        # chunks of at most N samples always fit in the buffer with the taps
+        for k in range(0, len(x), self.N):
+            xk = x[k:k+self.N]
+            B = len(xk)
+            self.x.push_block(xk)
+            # gather the delayed views as the columns of a contiguous
+            # (B * channels, taps) matrix, so that the tap sum is a single
+            # 2-D matrix-vector product (sgemv) with the taps vector
+            for j, d in enumerate(self.delays):
+                np.copyto(self.gather[:B, :, j], self.x.get_block(d, B))
+            M = self.gather[:B].reshape(-1, len(self.taps))
+            np.matmul(M, self.taps, out=y[k:k+B].reshape(-1))
 
 
 
@@ -39,16 +114,31 @@ class Recursive_Echo(RTProcessor):
     """
     order = 20
     def __init__(self, rate, channels):
-        # we will need a second's worth of buffering
-        super(Recursive_Echo, self).__init__(rate, channels, max_delay=rate)
-
-        self.a = 0.7
-        self.norm = (1 - self.a * self.a)
+        # the delay line is kept in a circular buffer
+        super(Recursive_Echo, self).__init__(rate, channels, max_delay=0)
+
+        a = 0.7
+        norm = 1 - a * a
+        # fold the normalization into the input and feedback gains
+        self.g = np.float32(norm)
+        self.a = np.float32(norm * a)
         self.N = int(0.3 * self.SF)
+        self.y = CircularBuffer(self.N, channels)
+        # scratch space for one chunk
+        self.tmp = np.empty((self.N, channels), dtype=np.float32)
 
-    def _process(self):
-        # y[n] = x[n] + ay[n-N]
-        return self.norm * (self.x.get(0) + self.a * self.y.get(self.N))
+    def _process_block(self, x, y):
+        # y[n] = x[n] + ay[n-N], scaled by norm
+        # the feedback reaches N samples back, so a chunk of at most N
+        # samples only depends on outputs that are already in the buffer
+        for k in range(0, len(x), self.N):
+            xk = x[k:k+self.N]
+            B = len(xk)
+            yk = y[k:k+B]
+            np.multiply(xk, self.g, out=yk)
+            np.multiply(self.y.get_block(self.N - B, B), self.a, out=self.tmp[:B])
+            yk += self.tmp[:B]
+            self.y.push_block(yk)
 
 
 
@@ -60,17 +150,33 @@ class Natural_Echo(RTProcessor):
     """
     order = 30
     def __init__(self, rate, channels):
-        # we will need a second's worth of buffering
-        super(Natural_Echo, self).__init__(rate, channels, max_delay=rate)
+        # the delay lines are kept in circular buffers
+        super(Natural_Echo, self).__init__(rate, channels, max_delay=0)
 
-        self.a = 0.8
-        self.l = 0.7
+        self.a = np.float32(0.8)
+        self.l = np.float32(0.7)
         self.N = int(0.3 * self.SF)
-
-    def _process(self):
-        #y [n] = x[n] + y[n-N] * h[n], h[n] leaky integrator
-        return self.x.get(0) - self.l * self.x.get(1) + \
-                       self.l * self.y.get(1) + self.a * (1-self.l) * self.y.get(self.N)
+        self.x = CircularBuffer(self.N, channels)
+        self.y = CircularBuffer(self.N, channels)
+        # scratch space for one chunk
+        self.tmp = np.empty((self.N, channels), dtype=np.float32)
+
+    def _process_block(self, x, y):
+        #y [n] = x[n] + y[n-N] * h[n], h[n] leaky integrator, i.e.
+        # y[n] = x[n] - lx[n-1] + ly[n-1] + a(1-l)y[n-N]
+        for k in range(0, len(x), self.N):
+            xk = x[k:k+self.N]
+            B = len(xk)
+            self.x.push_block(xk)
+            # everything but the y[n-1] term is a vector op (see Recursive_Echo),
+            # computed in the output block and then integrated in place
+            yk = y[k:k+B]
+            np.multiply(self.x.get_block(1, B), -self.l, out=yk)
+            yk += xk
+            np.multiply(self.y.get_block(self.N - B, B), self.a * (1-self.l), out=self.tmp[:B])
+            yk += self.tmp[:B]
+            leaky_block(yk, yk, self.y.get(0), self.l)
+            self.y.push_block(yk)
 
 
 
@@ -79,15 +185,32 @@ class Reverb(RTProcessor):
     """
     order = 40
     def __init__(self, rate, channels):
-        super(Reverb, self).__init__(rate, channels, max_delay=rate)
-
-        self.a = 0.8
-        self.norm = 0.5
+        # the delay lines are kept in circular buffers
+        super(Reverb, self).__init__(rate, channels, max_delay=0)
+
+        a = 0.8
+        norm = 0.5
+        # fold the normalization into the input and feedback gains
+        self.g = np.float32(norm)
+        self.a = np.float32(norm * a)
         self.N = int(0.02 * self.SF)
+        self.x = CircularBuffer(2 * self.N, channels)
+        self.y = CircularBuffer(self.N, channels)
+        # scratch space for one chunk
+        self.tmp = np.empty((self.N, channels), dtype=np.float32)
 
-    def _process(self):
-        # y[n] = -ax[n] + x[n-N] + ay[n-N]
-        return self.norm * (-self.x.get(0) + self.x.get(self.N) + self.a * self.y.get(self.N))
+    def _process_block(self, x, y):
+        # y[n] = -ax[n] + x[n-N] + ay[n-N], scaled by norm
+        for k in range(0, len(x), self.N):
+            xk = x[k:k+self.N]
+            B = len(xk)
+            self.x.push_block(xk)
+            yk = y[k:k+B]
+            np.subtract(self.x.get_block(self.N, B), xk, out=yk)
+            yk *= self.g
+            np.multiply(self.y.get_block(self.N - B, B), self.a, out=self.tmp[:B])
+            yk += self.tmp[:B]
+            self.y.push_block(yk)
 
 
 
@@ -106,18 +229,19 @@ class Biquad(RTProcessor):
         zm = 0.9
         zp = 0.06 * np.pi
 
-        self.b1 = -2 * zm * np.cos(zp)
-        self.b2 = zm * zm
-        self.a1 = -2 * pm * np.cos(pp)
-        self.a2 = pm * pm
+        # the output gain multiplies the whole recursion, feedback terms
+        # included, so it is folded into all five coefficients
+        norm = 0.1
+        self.b0 = np.float32(norm)
+        self.b1 = np.float32(norm * -2 * zm * np.cos(zp))
+        self.b2 = np.float32(norm * zm * zm)
+        self.a1 = np.float32(norm * -2 * pm * np.cos(pp))
+        self.a2 = np.float32(norm * pm * pm)
 
-        self.norm = 0.1
-
-    def _process(self):
-        # y[n] = x[n] + b_1x[n-1] + b_2x[n-2] - a_1y[n-1] - a_2y[n-2]
-        return self.norm * (
-            self.x.get(0) + self.b1 * self.x.get(1) + self.b2 * self.x.get(2)
-            - self.a1 * self.y.get(1) - self.a2 * self.y.get(2))
+    def _process_block(self, x, y):
+        # y[n] = x[n] + b_1x[n-1] + b_2x[n-2] - a_1y[n-1] - a_2y[n-2], scaled by norm
+        biquad_block(x, y, self.x_state, self.y_state,
+                     self.b0, self.b1, self.b2, self.a1, self.a2)
 
 
 
@@ -130,18 +254,14 @@ class Fuzz(RTProcessor):
         super(Fuzz, self).__init__(rate, channels)
 
         self.T = 0.005
-        self.G = 5
+        self.G = np.float32(5)
 
-        self.limit = 0x7FFFFFFF * self.T
+        self.limit = np.float32(0x7FFFFFFF * self.T)
 
-    def _process(self):
-        # y[n] = a trunc(x[n]/a)
-        y = self.x.get(0)
-        if (y > self.limit):
-            y = self.limit
-        if (y < -self.limit):
-            y = -self.limit
-        return self.G*y
+    def _process_block(self, x, y):
+        # y[n] = a trunc(x[n]/a); branchless: clip the whole block in a single pass
+        np.clip(x, -self.limit, self.limit, out=y)
+        y *= self.G
 
 
 
@@ -163,20 +283,41 @@ class Wah(RTProcessor):
         self.zero_mag = 0.9                      # zero magnitude
         self.zero_phase = 0.06 * np.pi           # zero phase
 
-        self.b2 = self.zero_mag * self.zero_mag
-        self.a2 = self.pole_mag * self.pole_mag
-
-    def _process(self):
-        # current angle of the pole
-        d = self.pole_delta * (1.0 + np.cos(self.omega)) / 2.0
-        self.omega += self.phi
-
-        # recompute the filter's coefficients
-        self.b1 = -2.0 * self.zero_mag * np.cos(self.zero_phase + d)
-        self.a1 = -2.0 * self.pole_mag * np.cos(self.pole_phase + d)
-
-        return 0.3 * (self.x.get(0) + self.b1 * self.x.get(1) + self.b2 * self.x.get(2) - \
-            self.a1 * self.y.get(1) - self.a2 * self.y.get(2))
+        # output gain, folded into all the filter's coefficients
+        self.b0 = np.float32(0.3)
+        self.b2 = np.float32(self.b0 * self.zero_mag * self.zero_mag)
+        self.a2 = np.float32(self.b0 * self.pole_mag * self.pole_mag)
+
+        self.alloc_scratch(4096)
+
+    def alloc_scratch(self, n):
+        # LFO phase ramp and per-frame coefficients for blocks of up to n frames
+        self.ramp = self.phi * np.arange(n)
+        self.lfo = np.empty(n)
+        self.d = np.empty(n, dtype=np.float32)
+        self.b1 = np.empty(n, dtype=np.float32)
+        self.a1 = np.empty(n, dtype=np.float32)
+
+    def _process_block(self, x, y):
+        B = len(x)
+        if B > len(self.d):
+            self.alloc_scratch(B)
+        lfo, d, b1, a1 = self.lfo[:B], self.d[:B], self.b1[:B], self.a1[:B]
+        # current angle of the pole, for each sample in the block
+        np.add(self.ramp[:B], self.omega, out=lfo)
+        np.cos(lfo, out=lfo)
+        lfo += 1.0
+        np.multiply(lfo, self.pole_delta / 2.0, out=d, casting='same_kind')
+        self.omega = np.mod(self.omega + self.phi * B, 2 * np.pi)
+        # recompute the filter's coefficients for the whole block...
+        np.add(d, self.zero_phase, out=b1)
+        np.cos(b1, out=b1)
+        b1 *= -2.0 * self.b0 * self.zero_mag
+        np.add(d, self.pole_phase, out=a1)
+        np.cos(a1, out=a1)
+        a1 *= -2.0 * self.b0 * self.pole_mag
+        # ...then run the recursion in numba
+        wah_block(x, y, b1, a1, self.b0, self.b2, self.a2, self.x_state, self.y_state)
 
 
 
@@ -189,11 +330,29 @@ class Tremolo(RTProcessor):
         # tremolo is memoryless
         super(Tremolo, self).__init__(rate, channels, max_delay=1)
 
-        self.depth = 0.9
+        self.depth = np.float32(0.9)
         self.phi = 5 * 2*np.pi / self.SF
         self.omega = 0
 
-
-    def _process(self):
-        self.omega += self.phi;
-        return ((1.0 - self.depth) + self.depth * 0.5 * (1 + np.cos(self.omega))) * self.x.get(0)
+        self.alloc_scratch(4096)
+
+    def alloc_scratch(self, n):
+        # LFO phase ramp and envelope for blocks of up to n frames
+        self.ramp = self.phi * np.arange(1, n + 1)
+        self.lfo = np.empty(n)
+        self.env = np.empty(n, dtype=np.float32)
+
+    def _process_block(self, x, y):
+        # compute the envelope for the whole block in one go:
+        # (1 - depth) + depth/2 (1 + cos) = (1 - depth/2) + depth/2 cos
+        B = len(x)
+        if B > len(self.env):
+            self.alloc_scratch(B)
+        lfo, env = self.lfo[:B], self.env[:B]
+        np.add(self.ramp[:B], self.omega, out=lfo)
+        np.cos(lfo, out=lfo)
+        np.multiply(lfo, 0.5 * self.depth, out=env, casting='same_kind')
+        env += 1.0 - 0.5 * self.depth
+        # keep the LFO phase in [0, 2pi) to preserve precision
+        self.omega = np.mod(self.omega + self.phi * B, 2 * np.pi)
+        np.multiply(env[:, np.newaxis], x, out=y)
@@ -1,32 +1,99 @@
 """ Signature base class for real-time audio processing
 
-RTProcessor implements a signature class for a simple single-sample processing
-unit. Initialize the calss with the sampling rate, the number of channels per
+RTProcessor implements a signature class for a block-based processing unit.
+Initialize the calss with the sampling rate, the number of channels per
 sample (default is 1, i.e. mono audio) and the maximum delay required by the
 processing module (e.g. a second order filter will require max_delay=2)
 
+The processor's memory is kept in two float32 arrays, x_state and y_state,
+holding the last max_delay input and output frames (x_state[k] is x[n-1-k]),
+with one column per channel; block kernels load them into local variables,
+run over the block and write them back. Processors with long delay lines can
+use CircularBuffer instead.
+
+process_block() processes a whole buffer of interleaved samples in one call
+and returns a view of a preallocated int32 output buffer; derived classes
+override _process_block() to implement the actual processing on float32
+scratch buffers, also preallocated. Processors keep any temporaries they need
+preallocated as well and write into them with out=, so that no arrays are
+allocated per block.
+The scratch buffers have shape (frames, channels): processors run over the
+frames and apply the same operation to all channels of a frame at once, with
+the channel axis innermost. process() is a convenience wrapper for a single
+frame.
+
+Simple processors can still be written one sample at a time by overriding
+_process() instead: the default _process_block() then loops over the block,
+keeping the input and output history in the circular buffers self.x and
+self.y, so that self.x.get(k) is x[n-k] and self.y.get(k) is y[n-k].
+
 "order" is an attribute that each derived class should redefine to determine
 the order of the available classes in an enumeration (useful for user interface)
 """
 __author__ = 'Paolo Prandoni'
 
+import numpy as np
+
 class RTProcessor(object):
     # position in list of available classes
     order = 1e6     # menu order
 
     def __init__(self, rate, channels=1, max_delay=1):
         self.SF = rate
-        self.x = CircularBuffer(max_delay)
-        self.y = CircularBuffer(max_delay)
+        self.channels = channels
+        self.x_state = np.zeros((max_delay, channels), dtype=np.float32)
+        self.y_state = np.zeros((max_delay, channels), dtype=np.float32)
+        # per-sample processors keep their history in circular buffers
+        self._per_sample = type(self)._process is not RTProcessor._process
+        if self._per_sample:
+            self.x = CircularBuffer(max_delay, channels)
+            self.y = CircularBuffer(max_delay, channels)
+        # scratch buffers reused by process_block(): float32 input and
+        # output for the processing itself, int32 for the result
+        self._fin = np.empty((4096, channels), dtype=np.float32)
+        self._fout = np.empty((4096, channels), dtype=np.float32)
+        self._iout = np.empty((4096, channels), dtype=np.int32)
 
     def process(self, sample):
-        self.x.push(sample)
-        y = self._process()
-        self.y.push(y)
-        return y
+        # a single frame, i.e. one sample per channel
+        y = self.process_block(np.array(sample, dtype=np.int32).reshape(-1))
+        return y[0] if self.channels == 1 else y
+
+    def process_block(self, x):
+        # process a whole buffer of interleaved samples at once; the result
+        # is a view of a buffer owned by the processor, valid until the next call
+        n = len(x) // self.channels
+        if n > len(self._iout):
+            self._fin = np.empty((n, self.channels), dtype=np.float32)
+            self._fout = np.empty((n, self.channels), dtype=np.float32)
+            self._iout = np.empty((n, self.channels), dtype=np.int32)
+        # convert in place, no temporary arrays
+        np.copyto(self._fin[:n], x.reshape(n, self.channels), casting='unsafe')
+        self._process_block(self._fin[:n], self._fout[:n])
+        # clamp to the int32 range first: float32 rounds 2**31 - 1 up to
+        # 2**31, which would wrap around to the most negative sample;
+        # 2**31 - 128 is the largest float32 below 2**31
+        np.clip(self._fout[:n], -2**31, 2**31 - 128, out=self._fout[:n])
+        np.copyto(self._iout[:n], self._fout[:n], casting='unsafe')
+        return self._iout[:n].reshape(-1)
+
+    def _process_block(self, x, y):
+        # this is the function to "override" for each new block processor:
+        # write the processed float32 block x into the float32 array y; both
+        # have shape (frames, channels). The default loops over _process()
+        if not self._per_sample:
+            y[:] = x
+            return
+        for n in range(len(x)):
+            self.x.push(x[n])
+            # reserve the slot for the current output so that y.get(k) is y[n-k]
+            self.y.push(0)
+            y[n] = self._process()
+            self.y.set(y[n])
 
     def _process(self):
-        # this is the function to "override" for each new processor
+        # this is the function to "override" for each new per-sample
+        # processor; the default is a pass-through
         return self.x.get(0)
 
 
@@ -40,18 +107,45 @@ class Delta(RTProcessor):
 
 
 """ Helper class: circular buffer """
-import numpy as np
 
 class CircularBuffer(object):
-    def __init__(self, length):
-        self.length = length + 1
-        self.buf = np.zeros(self.length)
-        self.ix = self.length - 1
+    """ The buffer is stored twice, back to back, so that any run of past
+    samples is a contiguous slice no matter where the write index is
+    """
+    def __init__(self, length, channels=1):
+        # room for length+1 frames, rounded up to a power of two so that
+        # indices wrap around with a bit mask instead of a modulo
+        self.length = 1 << length.bit_length()
+        self.mask = self.length - 1
+        self.buf = np.zeros((2 * self.length, channels), dtype=np.float32)
+        self.ix = self.mask
 
     def push(self, x):
-        self.ix = np.mod(self.ix + 1, self.length)
+        self.ix = (self.ix + 1) & self.mask
+        self.buf[self.ix] = x
+        self.buf[self.ix + self.length] = x
+
+    def set(self, x):
+        # overwrite the most recent frame
         self.buf[self.ix] = x
+        self.buf[self.ix + self.length] = x
 
     def get(self, n):
-        #print n, np.mod(self.ix + self.length - n, self.length)
-        return self.buf[np.mod(self.ix + self.length - n, self.length)]
+        return self.buf[self.ix + self.length - n]
+
+    def push_block(self, x):
+        # append a block of frames (no longer than the buffer) to both copies
+        L = self.length
+        start = (self.ix + 1) & self.mask
+        k = min(len(x), L - start)
+        self.buf[start:start + k] = x[:k]
+        self.buf[start + L:start + L + k] = x[:k]
+        self.buf[:len(x) - k] = x[k:]
+        self.buf[L:L + len(x) - k] = x[k:]
+        self.ix = (self.ix + len(x)) & self.mask
+
+    def get_block(self, n, B):
+        # view of the B frames ending n frames ago, i.e. x[t-n-B+1..t-n];
+        # requires n + B <= length
+        end = self.ix + self.length - n + 1
+        return self.buf[end - B:end]